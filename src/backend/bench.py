@@ -0,0 +1,570 @@
+"""Micro-benchmarks for the trainer backend.
+
+Usage:
+    python bench.py serialization [--rows 1000] [--repeat 200]
+    python bench.py stress [--threads 16] [--users 4] [--checkins 200] [--goals 32]
+    python bench.py memory [--goals 1000000] [--days 10000000]
+    python bench.py analytics [--users 10000] [--days 180]
+    python bench.py snapshot [--users 50000]
+    python bench.py startup [--runs 5] [--users 1000]
+    python bench.py maintenance [--rows 200000] [--repeat 2000]
+    python bench.py ai [--requests 64] [--latency 0.05] [--concurrency 8]
+    python bench.py admission [--workers 16] [--llm 200] [--cheap 200] [--latency 0.2]
+    python bench.py notifications [--users 100000] [--repeat 20]
+
+Benchmarks run against a throwaway SQLite file so they never touch trainer.db.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from datetime import date, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("TRAINER_DB", os.path.join(tempfile.mkdtemp(), "bench.db"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def _report(label, seconds, repeat):
+    print(f"  {label:<44} {seconds / repeat * 1e6:10.1f} us/op")
+
+
+def bench_serialization(args):
+    from flask import Flask
+    from flask.json.provider import DefaultJSONProvider
+    import main
+
+    rows = [
+        {
+            "date": f"2025-{(i // 28) % 12 + 1:02d}-{i % 28 + 1:02d}",
+            "status": "done" if i % 3 else "miss",
+            "focus_area": "Sleep & Recovery",
+            "task": "Go to bed 30 minutes earlier tonight",
+            "difficulty": i % 3 + 1,
+            "createdAt": "2025-01-01T09:00:00-08:00",
+        }
+        for i in range(args.rows)
+    ]
+    message = {"role": "assistant", "text": "Quick check-in: did you complete 'Walk 20 minutes' daily? Reply 'done' or 'miss'."}
+    body = {
+        "user_id": "testuser",
+        "query": "How can I sleep better?",
+        "health_data": "Age: 30\nVO2 Max: 45\nSleep: 7h/night",
+        "goals": [{"id": str(i), "title": f"Goal {i}", "category": "sleep", "cadence": "daily", "active": True}
+                  for i in range(5)],
+        "thread_id": "thread_abc",
+    }
+    raw_body = json.dumps(body).encode()
+
+    std_app = Flask("bench_std")
+    std_app.json = DefaultJSONProvider(std_app)
+    fast_app = main.app
+    print(f"orjson available: {main.orjson is not None}")
+
+    print(f"jsonify /api/checkins payload ({args.rows} rows)")
+    for label, app in (("stdlib DefaultJSONProvider", std_app), ("FastJSONProvider", fast_app)):
+        with app.app_context():
+            t = timeit.timeit(lambda: app.json.response(rows).get_data(), number=args.repeat)
+        _report(label, t, args.repeat)
+
+    n = args.repeat * 50
+    print("/stream framing (one message)")
+    _report("json.dumps", timeit.timeit(lambda: f"data: {json.dumps(message)}\n\n", number=n), n)
+    _report("app.json.dumps", timeit.timeit(lambda: f"data: {fast_app.json.dumps(message)}\n\n", number=n), n)
+
+    print("decode /generate-line body")
+
+    def decode_std():
+        data = json.loads(raw_body)
+        return (data.get("query", "").strip(), data.get("health_data", "").strip(),
+                data.get("goals", []), data.get("thread_id"), data.get("user_id", "testuser"))
+
+    def decode_typed():
+        with fast_app.test_request_context("/generate-line", method="POST", data=raw_body,
+                                           content_type="application/json"):
+            return main.parse_body(main.GenerateLineRequest)
+
+    def decode_untyped():
+        with std_app.test_request_context("/generate-line", method="POST", data=raw_body,
+                                          content_type="application/json"):
+            from flask import request
+            return decode_std() if request.get_json() is not None else None
+
+    _report("json.loads + .get chain", timeit.timeit(decode_std, number=n), n)
+    _report("request + stdlib get_json + .get chain", timeit.timeit(decode_untyped, number=args.repeat), args.repeat)
+    _report("request + fast get_json + parse_body", timeit.timeit(decode_typed, number=args.repeat), args.repeat)
+
+
+def bench_stress(args):
+    """Hammer /check-in and the multi-goal /generate-line flow from many threads.
+
+    Checks that no increments are lost under per-user locking; exits non-zero on a mismatch.
+    """
+    import main
+
+    app = main.app
+    failures = []
+    users = [f"stress{i}" for i in range(args.users)]
+    with app.test_client() as c:
+        for uid in users:
+            c.post("/generate-plan", json={"user_id": uid})
+
+    local = threading.local()
+
+    def post(path, body):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        resp = local.client.post(path, json=body)
+        if resp.status_code != 200:
+            failures.append(f"{path} {body.get('user_id')}: HTTP {resp.status_code}")
+
+    def check(uid, expected):
+        u = main.users[uid]
+        if u.get("total_days_completed") != expected:
+            failures.append(f"{uid}: total_days_completed={u.get('total_days_completed')} expected {expected}")
+        # Streaks count calendar days from the history: every check-in here lands on today
+        for key in ("consecutive_days", "best_gapless_streak"):
+            if u.get(key) != 1:
+                failures.append(f"{uid}: {key}={u.get(key)} expected 1")
+
+    print(f"/check-in: {args.threads} threads, {args.users} users x {args.checkins} 'done'")
+    jobs = [uid for uid in users for _ in range(args.checkins)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        list(pool.map(lambda uid: post("/check-in", {"user_id": uid, "status": "done"}), jobs))
+    elapsed = time.perf_counter() - start
+    _report("POST /check-in", elapsed, len(jobs))
+    for uid in users:
+        check(uid, args.checkins)
+
+    uid = users[0]
+    print(f"/generate-line: {args.goals}-goal check-in session, {args.goals} concurrent 'done' replies")
+    with app.test_client() as c:
+        for i in range(args.goals):
+            c.post("/debug/seed-goal", json={"user_id": uid, "title": f"Stress goal {i}"})
+        c.post("/debug/trigger-checkin-now", json={"user_id": uid})
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        list(pool.map(lambda _: post("/generate-line", {"user_id": uid, "query": "done"}), range(args.goals)))
+    elapsed = time.perf_counter() - start
+    _report("POST /generate-line (quick reply)", elapsed, args.goals)
+    check(uid, args.checkins + args.goals)
+    if uid in main.checkin_session or uid in main.awaiting_checkin:
+        failures.append(f"{uid}: check-in session not cleared after {args.goals} replies")
+
+    for f in failures[:20]:
+        print(f"  FAIL {f}")
+    print("ok" if not failures else f"{len(failures)} failure(s)")
+    if failures:
+        sys.exit(1)
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:  # not Linux: peak RSS is the best we have
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+def _memory_child(args):
+    """Build the stores in this (fresh) process and print the RSS they added as JSON."""
+    import gc
+    import main
+
+    compact = args.variant == "compact"
+    categories = ("fitness", "sleep", "nutrition", "habits", "mindfulness")
+    focus_areas = ("Physical Health", "Nutrition", "Sleep & Recovery", "Habits")
+    tasks = ("Stretch every morning", "Sleep 7+ hours", "Eat one extra vegetable", "Use a habit tracker daily")
+    start = date(2020, 1, 1)
+    gc.collect()
+    before = _rss_mb()
+
+    goals = {}
+    for i in range(args.goals):
+        uid = f"user{i // 10}"
+        # json-decoded request strings are fresh objects, so the dict layout pays for each copy
+        category, cadence = "".join(categories[i % 5]), "".join("daily")
+        fields = dict(id=f"{i:032x}", title=f"Goal {i % 1000}", category=category, cadence=cadence,
+                      active=True, createdAt="2025-01-01T09:00:00")
+        goals.setdefault(uid, []).append(main.GoalRecord(**fields) if compact else fields)
+    after_goals = _rss_mb()
+
+    days = {}
+    per_user = 1000
+    for u in range(args.days // per_user):
+        per_day = days[f"user{u}"] = main.CheckinHistory() if compact else {}
+        for d in range(per_user):
+            key = (start + timedelta(days=d)).isoformat()
+            status = "".join("done" if d % 3 else "miss")
+            if compact:
+                per_day.set(key, status)
+            else:
+                per_day[key] = dict(status=status, focus_area=focus_areas[d % 4], task=tasks[d % 4],
+                                    difficulty=d % 3 + 1, createdAt=None)
+    gc.collect()
+    after_days = _rss_mb()
+    print(json.dumps({"goals_mb": after_goals - before, "days_mb": after_days - after_goals}))
+
+def bench_memory(args):
+    if args.variant:
+        return _memory_child(args)
+    print(f"RSS added by {args.goals:,} goals and {args.days:,} check-in days (fresh process per layout)")
+    results = {}
+    for variant in ("dicts", "compact"):
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "memory", "--variant", variant,
+             "--goals", str(args.goals), "--days", str(args.days)],
+            capture_output=True, text=True, check=True,
+        )
+        results[variant] = json.loads(out.stdout.strip().splitlines()[-1])
+    for label, key, n in (("goals", "goals_mb", args.goals), ("check-in days", "days_mb", args.days)):
+        d, r = results["dicts"][key], results["compact"][key]
+        print(f"  {label:<14} dicts {d:9.1f} MB ({d * 2**20 / max(n, 1):6.1f} B/each)"
+              f"   compact {r:9.1f} MB ({r * 2**20 / max(n, 1):6.1f} B/each)   {d / max(r, 1e-9):4.1f}x")
+
+def bench_analytics(args):
+    """Cold vs cached /api/analytics/cohorts over a synthetic check-in history."""
+    import random
+    import uuid
+    import main
+
+    if main.load_numpy() is None:
+        sys.exit("analytics requires numpy")
+    rnd = random.Random(0)
+    today = date.today()
+    statuses = ("done", "done", "miss", "unknown")
+    focus_areas = ("Physical Health", "Nutrition", "Sleep & Recovery", "Habits", None)
+    rows = []
+    for u in range(args.users):
+        day = today - timedelta(days=rnd.randrange(args.days))
+        while day <= today:
+            rows.append((uuid.uuid4().hex, f"bench{u}", day.isoformat(), rnd.choice(statuses),
+                         rnd.choice(focus_areas), "task", rnd.randint(1, 3), f"{day.isoformat()}T09:00:00+00:00"))
+            day += timedelta(days=rnd.randint(1, 3))
+    main.create_app(load_data=False)
+    main._db_conn.executemany("INSERT INTO checkins VALUES (?,?,?,?,?,?,?,?)", rows)
+    main._db_conn.commit()
+    print(f"/api/analytics/cohorts: {args.users:,} users, {len(rows):,} check-ins over {args.days} days")
+    with main.app.test_client() as c:
+        for label in ("cold (chunked load + NumPy)", "cached (high-water mark probe)"):
+            start = time.perf_counter()
+            resp = c.get("/api/analytics/cohorts?days=90")
+            elapsed = time.perf_counter() - start
+            if resp.status_code != 200:
+                sys.exit(f"HTTP {resp.status_code}: {resp.get_data(as_text=True)}")
+            print(f"  {label:<44} {elapsed * 1e3:10.1f} ms")
+        main.db_upsert_checkin("bench0", today.isoformat(), "done", None, "task", 1,
+                               datetime.now().astimezone().isoformat())
+        start = time.perf_counter()
+        c.get("/api/analytics/cohorts?days=90")
+        print(f"  {'after one new check-in (recompute)':<44} {(time.perf_counter() - start) * 1e3:10.1f} ms")
+
+def bench_snapshot(args):
+    """Write a snapshot of N users' in-memory state, then time a cold boot that restores it."""
+    import main
+
+    if not main.SNAPSHOT_ENABLED:
+        sys.exit("snapshots are disabled (STATE_STORE=sqlite or SNAPSHOT_INTERVAL=0)")
+    main.create_app()
+    for i in range(args.users):
+        uid = f"snap{i}"
+        main.users[uid] = main.UserRecord(consecutive_days=i % 30, total_days_completed=i % 300, difficulty=i % 3 + 1,
+                                          current_focus_area="Habits", current_task="Use a habit tracker daily",
+                                          focus_areas_ordered=["Habits", "Nutrition", "Sleep & Recovery"])
+        main.facts_store[uid] = [{"topic": "sleep", "value": "7h"}, {"topic": "diet", "value": "vegetarian"}]
+        main.pending_messages[uid] = [{"role": "assistant", "text": "Quick check-in: did you walk today?"}]
+    start = time.perf_counter()
+    count = main.write_snapshot()
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(main.SNAPSHOT_PATH)
+    print(f"snapshot: {count:,} users, {size / 2**20:.1f} MB")
+    print(f"  {'write (atomic replace)':<44} {elapsed * 1e3:10.1f} ms")
+    code = ("import time; t = time.perf_counter(); import main; main.create_app(); "
+            "print(len(main.users), time.perf_counter() - t)")
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)), env=dict(os.environ, CACHE_MAX_USERS=str(args.users * 2)))
+    users, boot = out.stdout.split()
+    print(f"  {'cold boot of main (restores ' + users + ' users)':<44} {float(boot) * 1e3:10.1f} ms")
+
+_STARTUP_CHILD = """
+import json, sys, time
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+with main.app.test_client() as c:
+    c.get("/api/streaks?user_id=bench0")
+    t2 = time.perf_counter()
+    c.get("/api/streaks?user_id=bench0")
+    t3 = time.perf_counter()
+loaded = sorted(m for m in ("openai", "numpy", "pyarrow") if m in sys.modules)
+t4 = time.perf_counter()
+main.get_openai_client()
+t5 = time.perf_counter()
+print(json.dumps({"import": t1 - t0, "first": t2 - t1, "second": t3 - t2, "openai": t5 - t4, "loaded": loaded}))
+"""
+
+def bench_startup(args):
+    """Cold-start cost in fresh processes: import of main, first request (lazy init), a warm request."""
+    import main
+
+    main.create_app(load_data=False)
+    main._db_conn.executemany(
+        "INSERT OR REPLACE INTO user_stats (user_id, total_done, consecutive_done, best_streak, missed_in_row,"
+        " current_focus_area, current_task, difficulty, updated_at) VALUES (?, ?, 0, 0, 0, 'Habits', 'task', 1, ?)",
+        [(f"bench{i}", i % 50, datetime.now().isoformat()) for i in range(args.users)],
+    )
+    main._db_conn.commit()
+    env = dict(os.environ, OPENAI_API_KEY=os.environ.get("OPENAI_API_KEY", "sk-bench"), SNAPSHOT_INTERVAL="0")
+    print(f"startup: median of {args.runs} fresh processes, {args.users:,} users in user_stats")
+    for label, extra in (("LOAD_DATA=1", {}), ("LOAD_DATA=0", {"LOAD_DATA": "0"})):
+        runs = []
+        for _ in range(args.runs):
+            out = subprocess.run([sys.executable, "-c", _STARTUP_CHILD], capture_output=True, text=True, check=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)), env=dict(env, **extra))
+            runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        median = lambda key: sorted(r[key] for r in runs)[len(runs) // 2] * 1e3
+        print(f" {label}")
+        print(f"  {'import main':<44} {median('import'):10.1f} ms")
+        print(f"  {'first request (create_app on demand)':<44} {median('first'):10.1f} ms")
+        print(f"  {'second request':<44} {median('second'):10.1f} ms")
+        print(f"  {'first OpenAI client use (deferred import)':<44} {median('openai'):10.1f} ms")
+    print(f"  heavy modules imported before the first AI call: {', '.join(runs[0]['loaded']) or 'none'}")
+
+def bench_maintenance(args):
+    """Read latency with a WAL grown behind a pinned reader, then after a maintenance pass."""
+    import sqlite3
+    import uuid
+    import main
+
+    main.create_app(load_data=False)
+    # An open read transaction keeps SQLite's auto-checkpoint from recycling the WAL
+    reader = sqlite3.connect(main.DB_PATH)
+    reader.execute("BEGIN")
+    reader.execute("SELECT COUNT(*) FROM checkins").fetchone()
+    today = date.today()
+    for start in range(0, args.rows, 10_000):
+        main._db_conn.executemany("INSERT INTO checkins VALUES (?,?,?,?,?,?,?,?)", [
+            (uuid.uuid4().hex, f"bench{i % 1000}", (today - timedelta(days=i // 1000)).isoformat(), "done",
+             "Habits", "Use a habit tracker daily", 1, datetime.now().isoformat())
+            for i in range(start, min(start + 10_000, args.rows))
+        ])
+        main._db_conn.commit()
+    reader.rollback()
+    reader.close()
+
+    def probe(query, params, repeat):
+        conn = sqlite3.connect(main.DB_PATH)
+        seconds = timeit.timeit(lambda: conn.execute(query, params).fetchall(), number=repeat)
+        conn.close()
+        return seconds
+
+    def probes(label):
+        _report(f"indexed per-user query, {label}", probe(
+            "SELECT COUNT(*), SUM(difficulty) FROM checkins WHERE user_id = ?", ("bench7",), args.repeat), args.repeat)
+        _report(f"full table scan, {label}", probe(
+            "SELECT COUNT(*) FROM checkins WHERE task = ?", ("none",), 20), 20)
+
+    print(f"sqlite maintenance: {args.rows:,} check-ins written behind a pinned reader")
+    print(f"  {'WAL before':<44} {main.wal_size() / 2**20:10.1f} MB")
+    probes("large WAL")
+    for mode in ("PASSIVE", "TRUNCATE"):
+        record = main.checkpoint_wal(mode)
+        print(f"  {'checkpoint ' + mode + ' (' + str(record['checkpointed_frames']) + ' frames)':<44} "
+              f"{record['ms']:10.1f} ms")
+    start = time.perf_counter()
+    main.optimize_db(analyze=True)
+    print(f"  {'ANALYZE':<44} {(time.perf_counter() - start) * 1e3:10.1f} ms")
+    stats = main.db_maintenance_stats()
+    print(f"  {'WAL after':<44} {stats['wal_bytes'] / 2**20:10.1f} MB   ({stats['page_count']:,} pages)")
+    probes("after checkpoint")
+
+def bench_ai(args):
+    """Concurrent assistant runs through the async bridge against a fake client with fixed latency."""
+    import asyncio
+    from types import SimpleNamespace as NS
+    import main
+
+    async def respond(status="completed", **kwargs):
+        await asyncio.sleep(args.latency)
+        return NS(id="run", status=status, usage=NS(prompt_tokens=10, completion_tokens=5))
+
+    async def create_run(**kwargs):
+        return await respond(status="queued")
+
+    fake = NS(beta=NS(threads=NS(runs=NS(create=create_run, retrieve=respond), messages=NS(create=respond))))
+    main._openai_client = fake
+    main.ai.bridge = main.AsyncBridge(args.concurrency)
+
+    def one(i):
+        uid = f"bench{i}"
+        main.ai.add_message("/bench", uid, "thread", "hello")
+        main.ai.run_assistant("/bench", uid, "thread", poll_interval=args.latency, assistant_id="asst")
+
+    peak = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.requests) as pool:
+        futures = [pool.submit(one, i) for i in range(args.requests)]
+        while not all(f.done() for f in futures):
+            peak = max(peak, main.ai.bridge.in_flight)
+            time.sleep(args.latency / 10)
+        for f in futures:
+            f.result()
+    elapsed = time.perf_counter() - start
+    calls = sum(c["calls"] for c in main.ai.snapshot()["calls"])
+    stats = main.ai.bridge.stats()
+    print(f"ai bridge: {args.requests} concurrent runs, {calls} calls of {args.latency * 1e3:.0f} ms, "
+          f"limit {args.concurrency}")
+    print(f"  {'wall time':<44} {elapsed * 1e3:10.1f} ms")
+    print(f"  {'ideal at the limit (calls x latency / limit)':<44} {calls * args.latency / args.concurrency * 1e3:10.1f} ms")
+    print(f"  {'peak in flight / peak queued':<44} {peak:>6} / {stats['max_waiting']}")
+
+def bench_admission(args):
+    """Cheap-route latency on a fixed worker pool while many users flood an LLM route, with and without admission."""
+    import asyncio
+    from collections import Counter
+    from types import SimpleNamespace as NS
+    import main
+
+    async def chat(**kwargs):
+        await asyncio.sleep(args.latency)
+        return NS(choices=[NS(message=NS(content="null"))], usage=None)
+
+    main._openai_client = NS(chat=NS(completions=NS(create=chat)))
+    main.create_app(load_data=False)
+    local = threading.local()
+
+    def call(kind, i):
+        if not hasattr(local, "client"):
+            local.client = main.app.test_client()
+        if kind == "llm":
+            resp = local.client.post("/extract-fact", json={"user_id": f"flood{i % 50}", "message": "I run"})
+        else:
+            resp = local.client.get(f"/metrics/usage/bench{i}")
+        return resp.status_code, time.perf_counter()
+
+    def measure():
+        # Latency counts from submission, so time spent waiting for a free worker thread is included
+        jobs = [(kind, i) for i in range(max(args.llm, args.cheap))
+                for kind, n in (("llm", args.llm), ("cheap", args.cheap)) if i < n]
+        with ThreadPoolExecutor(args.workers) as pool:
+            submitted = [(kind, time.perf_counter(), pool.submit(call, kind, i)) for kind, i in jobs]
+            results = [(kind, started, *future.result()) for kind, started, future in submitted]
+        statuses = Counter((kind, status) for kind, _, status, _ in results)
+        cheap = sorted(finished - started for kind, started, _, finished in results if kind == "cheap")
+        return cheap, statuses
+
+    print(f"admission: {args.workers} worker threads, {args.llm} LLM requests ({args.latency * 1e3:.0f} ms each, "
+          f"50 users) interleaved with {args.cheap} cheap GETs")
+    limited = main.admission
+    unlimited = main.AdmissionControl({route: (1e9, 1e9) for route in main.LLM_ROUTE_LIMITS},
+                                      capacity=10**6, max_queued=0, user_max_inflight=10**6)
+    for label, admission in (("no admission control", unlimited), ("admission control", limited)):
+        main.admission = admission
+        cheap, statuses = measure()
+        pct = lambda q: cheap[min(len(cheap) - 1, int(q * len(cheap)))] * 1e3
+        print(f" {label}: " + ", ".join(f"{kind} {status} x{n}" for (kind, status), n in sorted(statuses.items())))
+        print(f"  {'cheap GET p50 / p99':<44} {pct(0.5):8.1f} / {pct(0.99):8.1f} ms")
+
+def bench_notifications(args):
+    """Top-of-the-hour poll: every user scheduled for this minute, served from the precomputed payloads."""
+    import main
+
+    main.create_app(load_data=False)
+    now = datetime.utcnow()
+    hhmm = now.strftime("%H:%M")
+    user_ids = [f"bench{i:06d}" for i in range(args.users)]
+    for start in range(0, args.users, 10_000):
+        chunk = user_ids[start:start + 10_000]
+        main._db_conn.executemany("INSERT INTO prefs (user_id, key, value) VALUES (?, ?, ?)", [
+            (user_id, key, value) for user_id in chunk
+            for key, value in (("tz", "UTC"), ("checkin_time", hhmm), ("channels", '["in_app"]'))
+        ])
+        main._db_conn.commit()
+    for user_id in user_ids:
+        main.users[user_id] = main.UserRecord(current_task="Walk 10 minutes", current_focus_area="Physical Health",
+                                              consecutive_days=3, missed_days_in_row=0)
+    client = main.app.test_client()
+
+    def poll():
+        resp = client.get("/checkins/due?window=5")
+        assert resp.status_code == 200, resp.status_code
+        return resp
+
+    print(f"notifications: {args.users:,} users due at {hhmm} UTC")
+    start = time.perf_counter()
+    due = len(poll().get_json())
+    print(f"  {'/checkins/due, no bulk pass yet (' + format(due, ',') + ' due)':<44} "
+          f"{(time.perf_counter() - start) * 1e3:10.1f} ms")
+    start = time.perf_counter()
+    main.precompute_notification_payloads(force=True)
+    print(f"  {'bulk pass (scheduler)':<44} {(time.perf_counter() - start) * 1e3:10.1f} ms")
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        poll()
+    print(f"  {'/checkins/due':<44} {(time.perf_counter() - start) / args.repeat * 1e3:10.1f} ms/poll")
+    _report("/daily-notification", timeit.timeit(
+        lambda: client.post("/daily-notification", json={"user_id": user_ids[len(user_ids) // 2]}),
+        number=args.repeat * 100), args.repeat * 100)
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("serialization", help="stdlib vs fast JSON provider, typed vs ad hoc decoding")
+    p.add_argument("--rows", type=int, default=1000)
+    p.add_argument("--repeat", type=int, default=200)
+    p.set_defaults(func=bench_serialization)
+    p = sub.add_parser("stress", help="concurrent check-ins and quick replies; fails on lost updates")
+    p.add_argument("--threads", type=int, default=16)
+    p.add_argument("--users", type=int, default=4)
+    p.add_argument("--checkins", type=int, default=200)
+    p.add_argument("--goals", type=int, default=32)
+    p.set_defaults(func=bench_stress)
+    p = sub.add_parser("memory", help="RSS of dict vs compact goals (slotted records) and check-in days (status arrays)")
+    p.add_argument("--goals", type=int, default=1_000_000)
+    p.add_argument("--days", type=int, default=10_000_000)
+    p.add_argument("--variant", choices=("dicts", "compact"), help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_memory)
+    p = sub.add_parser("analytics", help="cohort analytics endpoint: cold load vs high-water-mark cache")
+    p.add_argument("--users", type=int, default=10_000)
+    p.add_argument("--days", type=int, default=180)
+    p.set_defaults(func=bench_analytics)
+    p = sub.add_parser("snapshot", help="in-memory state snapshot: write time, size and restore-on-boot time")
+    p.add_argument("--users", type=int, default=50_000)
+    p.set_defaults(func=bench_snapshot)
+    p = sub.add_parser("startup", help="import time and first-request latency in fresh processes")
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--users", type=int, default=1000)
+    p.set_defaults(func=bench_startup)
+    p = sub.add_parser("maintenance", help="read latency against a large WAL vs after checkpoint + ANALYZE")
+    p.add_argument("--rows", type=int, default=200_000)
+    p.add_argument("--repeat", type=int, default=2000)
+    p.set_defaults(func=bench_maintenance)
+    p = sub.add_parser("ai", help="assistant runs through the async OpenAI bridge: concurrency limit and queueing")
+    p.add_argument("--requests", type=int, default=64)
+    p.add_argument("--latency", type=float, default=0.05)
+    p.add_argument("--concurrency", type=int, default=8)
+    p.set_defaults(func=bench_ai)
+    p = sub.add_parser("admission", help="cheap-route latency under an LLM flood, with and without admission control")
+    p.add_argument("--workers", type=int, default=16)
+    p.add_argument("--llm", type=int, default=200)
+    p.add_argument("--cheap", type=int, default=200)
+    p.add_argument("--latency", type=float, default=0.2)
+    p.set_defaults(func=bench_admission)
+    p = sub.add_parser("notifications", help="/checkins/due and /daily-notification for many users due at once")
+    p.add_argument("--users", type=int, default=100_000)
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_notifications)
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,189 @@
+"""Streaming bulk export of check-ins, goals, stats and rollups.
+
+Usage:
+    python export.py checkins [--format ndjson|csv|parquet] [--user-id ID] [--from YYYY-MM-DD] [--to YYYY-MM-DD]
+                              [--db trainer.db] [-o FILE]
+    python export.py goals|stats|rollups ...
+
+Rows are read from a read-only connection with fetchmany() and encoded one chunk at a time,
+so memory stays flat however large the table is. It is safe to run against a live trainer.db:
+a WAL reader sees one consistent snapshot and never blocks the server's writes.
+The same generators back GET /api/export/<table> in main.py.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sqlite3
+import sys
+
+# pyarrow is optional: only the parquet format needs it, so it is imported on first use
+# rather than slowing down every process that imports this module (main.py does).
+pa = pq = None
+
+
+def load_pyarrow():
+    """Import pyarrow into the module globals once; returns False when it isn't installed."""
+    global pa, pq
+    if pa is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:  # pragma: no cover - depends on the deployment
+            return False
+        pa, pq = pyarrow, pyarrow.parquet
+    return True
+
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "5000"))
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+# table -> (source table, [(column, type)], date column for --from/--to, ORDER BY backed by an index)
+EXPORTS = {
+    "checkins": ("checkins", [("user_id", "str"), ("date", "str"), ("status", "str"), ("focus_area", "str"),
+                              ("task", "str"), ("difficulty", "int"), ("created_at", "str")],
+                 "date", "user_id, date"),
+    "goals": ("goals", [("user_id", "str"), ("goal_id", "str"), ("title", "str"), ("category", "str"),
+                        ("cadence", "str"), ("active", "int"), ("created_at", "str")],
+              None, "user_id, goal_id"),
+    "stats": ("user_stats", [("user_id", "str"), ("total_done", "int"), ("consecutive_done", "int"),
+                             ("best_streak", "int"), ("missed_in_row", "int"), ("current_focus_area", "str"),
+                             ("current_task", "str"), ("difficulty", "int"), ("updated_at", "str")],
+              None, "user_id"),
+    "rollups": ("checkin_rollups", [("user_id", "str"), ("period", "str"), ("start", "str"), ("days", "int"),
+                                    ("done", "int"), ("miss", "int"), ("best_streak", "int"),
+                                    ("max_difficulty", "int"), ("focus_area", "str")],
+                "start", "user_id, period, start"),
+}
+
+
+def connect_readonly(db_path):
+    return sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False, timeout=30)
+
+
+def iter_chunks(conn, table, user_id=None, date_from=None, date_to=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Yield lists of row tuples, at most `chunk_rows` each, from one SELECT (one snapshot)."""
+    source, columns, date_col, order = EXPORTS[table]
+    clauses, params = [], []
+    if user_id:
+        clauses.append("user_id = ?")
+        params.append(user_id)
+    if date_col and date_from:
+        clauses.append(f"{date_col} >= ?")
+        params.append(date_from)
+    if date_col and date_to:
+        clauses.append(f"{date_col} <= ?")
+        params.append(date_to)
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    cur = conn.execute(f"SELECT {', '.join(c for c, _ in columns)} FROM {source}{where} ORDER BY {order}", params)
+    try:
+        while True:
+            rows = cur.fetchmany(chunk_rows)
+            if not rows:
+                return
+            yield rows
+    finally:
+        cur.close()
+
+
+def _ndjson(columns, chunks):
+    names = [c for c, _ in columns]
+    for rows in chunks:
+        yield "".join(json.dumps(dict(zip(names, row)), ensure_ascii=False) + "\n" for row in rows).encode()
+
+
+def _csv(columns, chunks):
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow([c for c, _ in columns])
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode()
+
+
+class _DrainSink(io.RawIOBase):
+    """Write-only file object for ParquetWriter whose bytes are taken out after each row group."""
+
+    def __init__(self):
+        self._parts = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._parts.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def _parquet(columns, chunks):
+    types = {"str": pa.string(), "int": pa.int64()}
+    schema = pa.schema([(name, types[kind]) for name, kind in columns])
+    sink = _DrainSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        for rows in chunks:  # one row group per chunk
+            writer.write_table(pa.Table.from_pylist([dict(zip(schema.names, row)) for row in rows], schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def export_stream(conn, table, fmt="ndjson", **filters):
+    """Generator of encoded byte chunks for `table` in `fmt`; closes `conn` when exhausted or closed."""
+    if fmt == "parquet" and not load_pyarrow():
+        raise RuntimeError("parquet export requires pyarrow")
+    columns = EXPORTS[table][1]
+    encode = {"ndjson": _ndjson, "csv": _csv, "parquet": _parquet}[fmt]
+    try:
+        for data in encode(columns, iter_chunks(conn, table, **filters)):
+            if data:
+                yield data
+    finally:
+        conn.close()
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("table", choices=sorted(EXPORTS))
+    parser.add_argument("--format", choices=sorted(FORMATS), default="ndjson")
+    parser.add_argument("--user-id")
+    parser.add_argument("--from", dest="date_from")
+    parser.add_argument("--to", dest="date_to")
+    parser.add_argument("--db", default=os.environ.get("TRAINER_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "trainer.db")))
+    parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    args = parser.parse_args(argv)
+    if args.format == "parquet" and not load_pyarrow():
+        parser.error("parquet export requires pyarrow")
+    if not os.path.exists(args.db):
+        parser.error(f"database not found: {args.db}")
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for data in export_stream(connect_readonly(args.db), args.table, args.format, user_id=args.user_id,
+                                  date_from=args.date_from, date_to=args.date_to):
+            out.write(data)
+    except sqlite3.Error as e:
+        sys.exit(f"export failed: {e}")
+    finally:
+        if args.output:
+            out.close()
+        else:
+            out.flush()
+
+
+if __name__ == "__main__":
+    main_cli()